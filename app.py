@@ -4,10 +4,20 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import plotly.express as px
 from datetime import datetime, date
 import os
-import smtplib
-from email.message import EmailMessage
+import glob
+import re
+import csv
+import hmac
+import threading
+import bcrypt
+
+try:
+    import polars as pl     # 선택 설치 — 설치되어 있으면 CSV → parquet 변환에 사용
+except ImportError:
+    pl = None
 
 # ============================================
 # Streamlit 기본 설정
@@ -22,7 +32,43 @@ st.set_page_config(
 # ============================================
 DATA_FILE = "merged_v2.csv"           # 새로운 VOC 통합데이터
 CONTACT_FILE = "contact_map.xlsx"     # 담당자 Mapping
-FEEDBACK_FILE = "feedback.csv"        # 활동내역 저장 파일
+CONTACT_PARQUET = "contact_map.parquet"   # 담당자 Mapping 변환 캐시
+CSV_ENCODINGS = ("utf-8-sig", "cp949")   # 원본 CSV 인코딩 후보 (순서대로 시도)
+PARQUET_VERSION = 6                   # 정제 파이프라인 변경 시 올림 → parquet 재생성
+LOG_FILE = "activity_log.csv"         # 활동내역 저장 파일
+LOG_COLUMNS = ["계약번호", "활동내용", "등록자", "등록일시", "비고"]
+
+# ============================================
+# 데이터 컬럼 / 타입 설정 (대시보드에서 실제 사용하는 컬럼만 로드)
+# ============================================
+FEE_COLS = ["월정료", "KTT월정료", "KTT월정료(조정)", "시설_KTT월정료(조정)"]
+DATE_COLS = ["접수일", "접수일시", "처리완료일시"]
+
+RISK_LEVELS = ["HIGH", "MEDIUM", "LOW"]
+RISK_DTYPE = pd.CategoricalDtype(RISK_LEVELS, ordered=True)
+
+MATCH_LABELS = {"O": "매칭(O)", "X": "비매칭(X)"}   # 체미매칭 화면 표시용 라벨 (내부 값은 O/X)
+
+KEEP_COLS = [
+    "계약번호", "상호", "관리지사", "담당자", "구역담당자",
+    "VOC유형중", "체미매칭", "리스크등급",
+] + FEE_COLS + DATE_COLS
+
+# 고유값이 많은 문자열 컬럼 → pyarrow 기반 string (category 는 저카디널리티 컬럼만)
+ARROW_STRING_COLS = ["계약번호", "계약번호_정제", "상호"]
+
+DTYPES = {
+    "계약번호": "string[pyarrow]",
+    "상호": "string[pyarrow]",
+    "관리지사": "category",
+    "담당자": "category",
+    "구역담당자": "category",
+    "VOC유형중": "category",
+    "체미매칭": "category",
+    "리스크등급": RISK_DTYPE,
+    **{c: "string" for c in FEE_COLS},
+    **{c: "string" for c in DATE_COLS},
+}
 
 # ============================================
 # SMTP 환경변수 (Streamlit Cloud Secrets)
@@ -32,6 +78,7 @@ SMTP_PORT = int(st.secrets["SMTP_PORT"])
 SMTP_USER = st.secrets["SMTP_USER"]
 SMTP_PASSWORD = st.secrets["SMTP_PASSWORD"]
 SENDER_NAME = st.secrets["SENDER_NAME"]
+SMTP_TIMEOUT = 10     # 초 — 반쯤 끊긴 연결에서 noop/send 가 무한정 대기하지 않도록
 
 # ============================================
 # 공통 함수
@@ -39,26 +86,28 @@ SENDER_NAME = st.secrets["SENDER_NAME"]
 def safe_str(x):
     return "" if pd.isna(x) else str(x).strip()
 
-def clean_contract_number(x):
-    """계약번호 숫자만 남겨 8자리로 통일"""
-    if pd.isna(x):
-        return ""
-    s = "".join([c for c in str(x) if c.isdigit()])
-    return s[:8] if len(s) >= 8 else s
+NON_DIGIT = re.compile(r"\D+")
+
+def clean_contract_number(s):
+    """계약번호 숫자만 남겨 8자리로 통일 (Series 단위, 1회 순회·1회 할당)"""
+    vals = s.to_numpy(dtype=object)
+    return pd.Series(
+        pd.array(
+            [NON_DIGIT.sub("", v)[:8] if isinstance(v, str) else "" for v in vals],
+            dtype="string[pyarrow]",
+        ),
+        index=s.index,
+    )
 
-def clean_monthly_fee(x):
-    """월정료 원단위 → 천원단위로 변환 & 콤마포맷"""
-    if pd.isna(x):
-        return np.nan
-    s = str(x).replace(",", "").strip()
-    if not s.isdigit():
-        return np.nan
-    v = int(s)
-    v = round(v / 1000)     # 원단위 → 천원단위
-    return v
+def clean_monthly_fee(s):
+    """월정료 원단위 → 천원단위로 변환 (숫자만 허용, 음수·소수 등 → <NA>)"""
+    s = s.astype("string").str.replace(",", "", regex=False).str.strip()
+    s = s.where(s.str.fullmatch(r"\d+").fillna(False))    # 기존 isdigit 규칙 유지
+    v = pd.to_numeric(s, errors="coerce")
+    return (v / 1000).round().astype("Int32")     # 원단위 → 천원단위
 
 def parse_date_safe(x):
-    """강력 날짜 파싱"""
+    """강력 날짜 파싱 (단건용 — 컬럼 전체는 pd.to_datetime 사용)"""
     if pd.isna(x):
         return pd.NaT
 
@@ -86,33 +135,108 @@ def parse_date_safe(x):
 # ============================================
 # 데이터 불러오기
 # ============================================
-@st.cache_data
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        st.error("❌ merged_v2.csv 파일을 찾을 수 없습니다.")
-        return pd.DataFrame()
-
-    df = pd.read_csv(DATA_FILE, dtype=str)
+def _detect_encoding(csv_path):
+    """CSV_ENCODINGS 중 파일 전체를 디코딩할 수 있는 첫 인코딩"""
+    with open(csv_path, "rb") as f:
+        raw = f.read()
+    for enc in CSV_ENCODINGS:
+        try:
+            raw.decode(enc)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return CSV_ENCODINGS[0]     # 모두 실패 → read_csv 에서 오류 표시
+
+def _read_csv(csv_path, usecols, encoding):
+    """원본 CSV 로드 + 계약번호 정제 (polars 있으면 lazy scan, 없으면 pandas C 엔진)"""
+    if pl is not None and encoding == "utf-8-sig":     # polars 는 UTF-8 만 지원
+        lf = pl.scan_csv(csv_path, infer_schema_length=0).select(usecols)
+        lf = lf.with_columns(
+            pl.col("계약번호").str.replace_all(r"\D", "").str.slice(0, 8).fill_null("")
+        )
+        df = lf.collect().to_pandas()
+        return df.astype({c: DTYPES[c] for c in usecols})
+
+    df = pd.read_csv(
+        csv_path,
+        usecols=usecols,
+        dtype={c: DTYPES[c] for c in usecols},
+        encoding=encoding,      # C 엔진: 따옴표 안 줄바꿈 필드 처리 (pyarrow 엔진은 불가)
+    )
+    df["계약번호"] = clean_contract_number(df["계약번호"])
+    return df
 
-    # 계약번호 정제
-    df["계약번호"] = df["계약번호"].apply(clean_contract_number)
+def _clean_data(df):
+    """원본 CSV 정제 (parquet 변환 시 1회만 수행)"""
+    # 계약번호_정제 (계약번호는 _read_csv 에서 이미 정제됨)
+    df["계약번호_정제"] = df["계약번호"]
 
-    # 비매칭 여부(B열)
-    if "매칭" in df.columns:
-        df["매칭여부"] = df["매칭"].apply(lambda x: "X" if str(x).upper() == "X" else "O")
+    # 월정료 처리 (FEE_COLS 중 처음 존재하는 컬럼 기준, 숫자 아님 → 0)
+    fee_col = next((c for c in FEE_COLS if c in df.columns), None)
+    if fee_col:
+        df["월정료_천원"] = clean_monthly_fee(df[fee_col]).fillna(0)
     else:
-        df["매칭여부"] = "O"
+        df["월정료_천원"] = 0
 
-    # 월정료 처리
-    if "월정료" in df.columns:
-        df["월정료_천원"] = df["월정료"].apply(clean_monthly_fee)
+    # 날짜 파싱 (DATE_COLS 에 지정한 컬럼만)
+    for c in DATE_COLS:
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c], errors="coerce", cache=True, format="mixed")
 
-    # 날짜 파싱
-    if "접수일" in df.columns:
-        df["접수일"] = df["접수일"].apply(parse_date_safe)
+    # 접수일자 (시각 제거) — 날짜 범위 필터용, 접수일 없으면 접수일시 기준
+    recv_col = next((c for c in ("접수일", "접수일시") if c in df.columns), None)
+    if recv_col:
+        df["접수일_date"] = df[recv_col].dt.normalize()
 
     return df
 
+def _write_parquet(df, path, **kwargs):
+    """임시 파일에 쓴 뒤 os.replace → 동시 변환·중단 시에도 잘린 parquet 가 남지 않음"""
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        df.to_parquet(tmp, index=False, **kwargs)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _ensure_parquet(csv_path):
+    """parquet 가 없거나 CSV 보다 오래되었으면 정제 후 parquet 로 변환"""
+    base = os.path.splitext(csv_path)[0]
+    pq_path = f"{base}.v{PARQUET_VERSION}.parquet"
+    if os.path.exists(pq_path) and os.path.getmtime(pq_path) >= os.path.getmtime(csv_path):
+        return pq_path
+
+    encoding = _detect_encoding(csv_path)
+    header = pd.read_csv(csv_path, nrows=0, encoding=encoding).columns
+    usecols = [c for c in KEEP_COLS if c in header]
+    df = _clean_data(_read_csv(csv_path, usecols, encoding))
+    _write_parquet(df, pq_path, engine="pyarrow", compression="zstd")
+
+    # 이전 버전 parquet / 이전 mtime 의 디스크 캐시(pickle) 정리
+    for old in [f"{base}.parquet"] + glob.glob(f"{base}.v*.parquet"):
+        if old != pq_path and os.path.exists(old):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    _read_parquet.clear()
+    return pq_path
+
+@st.cache_data(persist="disk", max_entries=2, show_spinner=False)
+def _read_parquet(pq_path, mtime):
+    # mtime 은 캐시 키 용도 → parquet 재생성 시 디스크 캐시 무효화
+    df = pd.read_parquet(pq_path, engine="pyarrow")
+    return df.astype({c: "string[pyarrow]" for c in ARROW_STRING_COLS if c in df.columns})
+
+def load_data():
+    if not os.path.exists(DATA_FILE):
+        st.error("❌ merged_v2.csv 파일을 찾을 수 없습니다.")
+        return pd.DataFrame()
+
+    pq_path = _ensure_parquet(DATA_FILE)
+    return _read_parquet(pq_path, os.path.getmtime(pq_path))
+
 # ============================================
 # 담당자 Mapping 불러오기
 # ============================================
@@ -122,13 +246,22 @@ def load_contact_map():
         st.warning("⚠ contact_map.xlsx 파일이 존재하지 않습니다.")
         return pd.DataFrame()
 
-    df = pd.read_excel(CONTACT_FILE)
+    # xlsx 가 parquet 보다 최신일 때만 1회 변환 (openpyxl 은 여기서만 로드)
+    if not os.path.exists(CONTACT_PARQUET) or \
+            os.path.getmtime(CONTACT_PARQUET) < os.path.getmtime(CONTACT_FILE):
+        try:
+            _write_parquet(pd.read_excel(CONTACT_FILE, dtype=str), CONTACT_PARQUET)
+        except ImportError:
+            st.warning("⚠ openpyxl 이 설치되어 있지 않아 contact_map.xlsx 를 읽을 수 없습니다.")
+            return pd.DataFrame()
+
+    df = pd.read_parquet(CONTACT_PARQUET)
     df.columns = [c.strip() for c in df.columns]
 
     # 담당자 기본 컬럼명 정제
     name_col = [c for c in df.columns if "담당" in c or "성명" in c][0]
-    phone_col = [c for c in df.columns if "휴대" in c or "연락" in c][0]
-    email_col = [c for c in df.columns if "메일" in c or "email" in c.lower()][0]
+    phone_col = [c for c in df.columns if "휴대" in c or "연락" in c or "연략" in c][0]
+    email_col = [c for c in df.columns if "메일" in c or "mail" in c.lower()][0]
 
     df.rename(columns={
         name_col: "담당자",
@@ -138,17 +271,47 @@ def load_contact_map():
 
     return df
 
+@st.cache_data
+def build_manager_contacts(contact_df):
+    """담당자명 → {전화번호 뒷4자리, 이메일, 소속 지사} 조회용 dict (동명이인은 첫 행 기준)"""
+    contacts = {}
+    if contact_df.empty:
+        return contacts
+
+    branches = contact_df["소속"] if "소속" in contact_df.columns else [None] * len(contact_df)
+
+    for name, phone, email, branch in zip(
+        contact_df["담당자"], contact_df["전화번호"], contact_df["이메일"], branches
+    ):
+        phone = safe_str(phone)
+        contacts.setdefault(name, {
+            "last4": phone[-4:] if len(phone) >= 4 else None,
+            "email": safe_str(email),
+            "branch": safe_str(branch) or None,
+        })
+    return contacts
+
 # ============================================
 # 활동내역 로드
 # ============================================
 @st.cache_data
-def load_feedback():
-    if not os.path.exists(FEEDBACK_FILE):
-        return pd.DataFrame(columns=["계약번호", "내용", "등록자", "등록일시", "비고"])
-    return pd.read_csv(FEEDBACK_FILE, dtype=str)
+def load_logs():
+    if os.path.exists(LOG_FILE):
+        try:
+            return pd.read_csv(LOG_FILE, encoding="utf-8-sig")
+        except:
+            return pd.read_csv(LOG_FILE)
+    else:
+        return pd.DataFrame(columns=LOG_COLUMNS)
 
-def save_feedback(df):
-    df.to_csv(FEEDBACK_FILE, index=False, encoding="utf-8-sig")
+def append_log(row):
+    """활동내역 1건을 CSV 끝에 추가 (전체 파일 재작성 없음)"""
+    write_header = not os.path.exists(LOG_FILE)
+    with open(LOG_FILE, "a", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f)
+        if write_header:
+            w.writerow(LOG_COLUMNS)
+        w.writerow(row)
 
 # --------------------------------------------
 # PART 2 — 로그인 & 권한 시스템
@@ -173,18 +336,24 @@ LOGIN_TYPES = {
 }
 
 # ----------------------------------------------------------
-# ◼ 중간관리자(지사) 비밀번호 테이블
+# ◼ 관리자 / 중간관리자(지사) 비밀번호 — bcrypt 해시 (Streamlit Cloud Secrets)
+#     설정 형식은 README 참고, 미설정 시 해당 로그인 탭만 비활성
 # ----------------------------------------------------------
-BRANCH_ADMIN_PW = {
-    "중앙": "C001",
-    "강북": "C002",
-    "서대문": "C003",
-    "고양": "C004",
-    "의정부": "C005",
-    "남양주": "C006",
-    "강릉": "C007",
-    "원주": "C008"
-}
+@st.cache_resource
+def admin_hash():
+    h = st.secrets.get("ADMIN_PW_HASH")
+    return h.encode() if h else None
+
+@st.cache_resource
+def branch_hashes():
+    return {k: v.encode() for k, v in st.secrets.get("BRANCH_PW_HASH", {}).items()}
+
+def check_pw(pw, hashed):
+    """bcrypt 해시 비교 (상수시간, 잘못된 형식의 해시 → 실패 처리)"""
+    try:
+        return bcrypt.checkpw(pw.encode(), hashed)
+    except ValueError:
+        return False
 
 # ----------------------------------------------------------
 # ◼ 로그인 UI 구성
@@ -201,9 +370,11 @@ def login_screen(contact_df):
     # 1) 최고관리자 로그인
     # -----------------------------
     with tab_admin:
+        if admin_hash() is None:
+            st.error("ADMIN_PW_HASH 가 Secrets 에 설정되어 있지 않습니다.")
         admin_pw = st.text_input("관리자 비밀번호", type="password")
-        if st.button("로그인 (관리자)"):
-            if admin_pw == "C3A":
+        if st.button("로그인 (관리자)", disabled=admin_hash() is None):
+            if check_pw(admin_pw, admin_hash()):
                 st.session_state["login_type"] = "admin"
                 st.session_state["login_user"] = "ADMIN"
                 st.success("관리자 로그인 성공")
@@ -215,11 +386,13 @@ def login_screen(contact_df):
     # 2) 지사 중간관리자
     # -----------------------------
     with tab_branch:
-        branch = st.selectbox("지사 선택", list(BRANCH_ADMIN_PW.keys()))
+        if not branch_hashes():
+            st.error("BRANCH_PW_HASH 가 Secrets 에 설정되어 있지 않습니다.")
+        branch = st.selectbox("지사 선택", list(branch_hashes().keys()))
         pw = st.text_input("중간관리자 비밀번호", type="password")
 
-        if st.button("로그인 (지사관리자)"):
-            if pw == BRANCH_ADMIN_PW[branch]:
+        if st.button("로그인 (지사관리자)", disabled=not branch_hashes()):
+            if check_pw(pw, branch_hashes()[branch]):
                 st.session_state["login_type"] = "branch_admin"
                 st.session_state["login_user"] = branch + "_ADMIN"
                 st.session_state["login_branch"] = branch
@@ -234,25 +407,23 @@ def login_screen(contact_df):
     # -----------------------------
     with tab_user:
 
-        df = contact_df.copy()
-        df["전화번호"] = df["전화번호"].astype(str)
+        contacts = build_manager_contacts(contact_df)
 
         name = st.text_input("담당자 이름")
         pw = st.text_input("전화번호 뒷 4자리", type="password")
 
         if st.button("로그인 (담당자)"):
 
-            row = df[df["담당자"] == name]
+            entry = contacts.get(name)
 
-            if row.empty:
+            if entry is None:
                 st.error("등록되지 않은 담당자입니다.")
             else:
-                real_phone = row.iloc[0]["전화번호"]
-                last4 = real_phone[-4:] if len(real_phone) >= 4 else None
-
-                if pw == last4:
+                last4 = entry["last4"]
+                if last4 and hmac.compare_digest(pw.encode(), last4.encode()):
                     st.session_state["login_type"] = "user"
                     st.session_state["login_user"] = name
+                    st.session_state["login_branch"] = entry["branch"]
                     st.success(f"{name} 담당자 로그인 성공!")
                     st.rerun()
                 else:
@@ -278,33 +449,38 @@ def filter_by_role(df):
     login_user = st.session_state["login_user"]
     login_branch = st.session_state.get("login_branch")
 
-    df_role = df.copy()
-
-    # 최고관리자 → 전체 접근
-    if login_type == "admin":
-        return df_role
-
-    # 공용모드 → 전체 조회 가능, 수정 불가
-    if login_type == "public":
-        return df_role
+    mask = None     # None → 전체 접근 (최고관리자 / 공용모드 / 컬럼 없음)
 
     # 지사 중간관리자 → 해당 지사 전체 데이터
-    if login_type == "branch_admin":
-        if "관리지사" in df_role.columns:
-            return df_role[df_role["관리지사"] == login_branch]
-        else:
-            return df_role
+    if login_type == "branch_admin" and "관리지사" in df.columns:
+        mask = df["관리지사"].values == login_branch
 
     # 담당자 로그인 → 담당자 본인 데이터만 보기
-    if login_type == "user":
-        if "담당자" in df_role.columns:
-            return df_role[df_role["담당자"] == login_user]
-        elif "구역담당자" in df_role.columns:
-            return df_role[df_role["구역담당자"] == login_user]
-        else:
-            return df_role  # 컬럼 없을 경우 전체 조회 fallback
+    elif login_type == "user":
+        col = "담당자" if "담당자" in df.columns else \
+            ("구역담당자" if "구역담당자" in df.columns else None)
+        if col:
+            mask = df[col].values == login_user
+
+    # 필터 없으면 복사 없이 그대로, 있으면 mask 1회 적용
+    return df if mask is None else df.loc[mask]
+
+# ----------------------------------------------------------
+# ◼ 로그인 확인 → 미로그인 시 로그인 화면만 표시
+# ----------------------------------------------------------
+contact_df = load_contact_map()
 
-    return df_role 
+if st.session_state["login_type"] is None:
+    login_screen(contact_df)
+    st.stop()
+
+LOGIN_TYPE = st.session_state["login_type"]
+LOGIN_USER = st.session_state["login_user"]
+
+df = load_data()
+
+if df.empty:    # 데이터 파일 없음 → load_data 에서 오류 표시 후 중단
+    st.stop()
 
 # ------------------------------------------------------------
 # PART 3 — 대시보드 화면 구성 (필터 + KPI + 시각화)
@@ -312,98 +488,132 @@ def filter_by_role(df):
 
 st.markdown("## 📊 해지 VOC 통합 대시보드")
 
-df_view = df.copy()
-df_view = filter_by_role(df_view)   # 로그인 권한 필터 적용
+df_view = filter_by_role(df)   # 로그인 권한 필터 적용 (load_data 결과는 호출마다 새 객체 → 복사 불필요)
 
 
 # ------------------------------------------------------------
-# 📌 1) 계약번호 정제 (8자리 숫자)
+# 📌 1) 경과일 / 리스크등급 산출 (접수일_date 기준, 원본에 등급이 없을 때만)
+#     접수일_date 는 접수일 → 없으면 접수일시 에서 만든 날짜
 # ------------------------------------------------------------
-def clean_contract(x):
-    if pd.isna(x):
-        return ""
-    s = re.sub(r"[^0-9]", "", str(x))
-    return s[:8] if len(s) >= 8 else s
-
-df_view["계약번호_정제"] = df_view["계약번호"].apply(clean_contract) \
-    if "계약번호" in df_view.columns else df_view.get("계약번호_정제", "")
+if "접수일_date" in df_view.columns and "리스크등급" not in df_view.columns:
+    days = (pd.Timestamp(date.today()) - df_view["접수일_date"]).dt.days
+    # assign → 파생 컬럼을 붙인 새 프레임 (권한 필터 결과 원본은 건드리지 않음)
+    df_view = df_view.assign(
+        경과일=days,
+        리스크등급=pd.Series(
+            np.select([days.isna(), days <= 3, days <= 10], ["LOW", "HIGH", "MEDIUM"], default="LOW"),
+            index=df_view.index,
+        ).astype(RISK_DTYPE),
+    )
 
 
 # ------------------------------------------------------------
-# 📌 2) 월정료(원) → 천원단위 정제
+# 📌 2) 글로벌 필터 UI
 # ------------------------------------------------------------
-def parse_fee(v):
-    if pd.isna(v):
-        return 0
-    s = str(v).replace(",", "").strip()
-    if not s.isdigit():
-        return 0
-    w = int(s)
-    return round(w / 1000)
-
-fee_col = None
-for col in ["월정료", "KTT월정료", "KTT월정료(조정)", "시설_KTT월정료(조정)"]:
-    if col in df_view.columns:
-        fee_col = col
-        break
-
-if fee_col:
-    df_view["월정료_천원"] = df_view[fee_col].apply(parse_fee)
-else:
-    df_view["월정료_천원"] = 0
+# 캐시 키: 데이터 버전 + 로그인 권한 (df_view 결정 요소)
+#   캐시 함수는 프레임을 _df(해시 생략)로 받고 view_key / filter_key 로만 캐시
+view_key = (
+    os.path.getmtime(DATA_FILE) if os.path.exists(DATA_FILE) else None,
+    date.today(),
+    st.session_state["login_type"],
+    st.session_state.get("login_branch"),
+    st.session_state["login_user"],
+)
 
+def column_options(s):
+    """컬럼 값 → 정렬된 선택지 목록"""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # 카테고리는 이미 정렬·중복제거 상태 → 필터로 사라진 값만 제외
+        return s.cat.remove_unused_categories().cat.categories.tolist()
+    return sorted(s.dropna().unique().tolist())
+
+@st.cache_data(max_entries=32)
+def option_lists(_df, key):
+    """필터 선택지 (key = view_key 단위로 1회 계산)"""
+    def _opts(col):
+        return column_options(_df[col]) if col in _df.columns else []
+
+    return {
+        "branches": _opts("관리지사"),
+        "voc_mid": _opts("VOC유형중"),
+    }
+
+@st.cache_data(max_entries=64)
+def manager_options(_df, key, branches):
+    """선택한 지사 소속 담당자 선택지 (key + 지사 선택 단위 캐시)"""
+    if "담당자" not in _df.columns:
+        return []
+    if "전체" in branches or "관리지사" not in _df.columns:
+        return column_options(_df["담당자"])
+    return column_options(_df.loc[_df["관리지사"].isin(branches), "담당자"])
+
+opts = option_lists(df_view, view_key)
 
-# ------------------------------------------------------------
-# 📌 3) 글로벌 필터 UI
-# ------------------------------------------------------------
 st.sidebar.markdown("### 🎛 글로벌 필터")
 
-branches = sorted(df_view["관리지사"].dropna().unique()) \
-    if "관리지사" in df_view.columns else []
+# 폼 안의 위젯은 [적용] 클릭 시에만 rerun → 필터 조작마다 재계산하지 않음
+with st.sidebar.form("filters"):
 
-sel_branches = st.sidebar.multiselect("📍 지사 선택", ["전체"] + branches, default=["전체"])
+    sel_branches = st.multiselect("📍 지사 선택", ["전체"] + opts["branches"], default=["전체"])
 
-managers = sorted(df_view["담당자"].dropna().unique()) \
-    if "담당자" in df_view.columns else []
+    managers = manager_options(df_view, view_key, tuple(sel_branches))
 
-sel_managers = st.sidebar.multiselect("👤 담당자 선택", ["전체"] + managers, default=["전체"])
+    sel_managers = st.multiselect("👤 담당자 선택", ["전체"] + managers, default=["전체"])
 
-risk_levels = ["HIGH", "MEDIUM", "LOW"]
-sel_risk = st.sidebar.multiselect("⚠ 리스크 등급", risk_levels, default=risk_levels)
+    sel_risk = st.multiselect("⚠ 리스크 등급", RISK_LEVELS, default=RISK_LEVELS)
 
-match_levels = ["X", "O"]
-sel_match = st.sidebar.multiselect("🔍 매칭여부 (X=비매칭)", match_levels, default=match_levels)
+    match_levels = ["X", "O"]
+    sel_match = st.multiselect(
+        "🔍 매칭여부", match_levels, default=match_levels, format_func=MATCH_LABELS.get
+    )
 
-fee_min, fee_max = st.sidebar.slider("💰 월정료(천원) 범위", 0, 500, (0, 500))
+    fee_min, fee_max = st.slider("💰 월정료(천원) 범위", 0, 500, (0, 500))
 
-daterange = st.sidebar.date_input("📅 날짜 범위", [])
+    daterange = st.date_input("📅 날짜 범위", [])
 
-sel_voc_mid = st.sidebar.selectbox(
-    "📌 VOC 중분류", 
-    ["전체"] + sorted(df_view["VOC유형중"].dropna().unique()) if "VOC유형중" in df_view else ["전체"]
-)
+    sel_voc_mid = st.selectbox("📌 VOC 중분류", ["전체"] + opts["voc_mid"])
+
+    st.form_submit_button("✅ 필터 적용")
 
 st.sidebar.markdown("---")
 
+# 캐시 키: view_key + 필터 상태 (df_f 결정 요소)
+filter_key = view_key + (
+    tuple(sel_branches), tuple(sel_managers), tuple(sel_risk), tuple(sel_match),
+    fee_min, fee_max, tuple(map(str, daterange)), sel_voc_mid,
+)
+
 
 # ------------------------------------------------------------
-# 📌 4) 필터 적용
+# 📌 3) 필터 적용
 # ------------------------------------------------------------
-df_f = df_view.copy()
-
-if "전체" not in sel_branches:
-    df_f = df_f[df_f["관리지사"].isin(sel_branches)]
-
-if "전체" not in sel_managers:
-    df_f = df_f[df_f["담당자"].isin(sel_managers)]
+@st.cache_data(max_entries=32)
+def build_indices(_df, key):
+    """필터 컬럼별 {값: 행 위치 배열} 인덱스 (key = view_key 단위로 1회 계산)"""
+    cols = {"branch": "관리지사", "mgr": "담당자", "risk": "리스크등급", "match": "체미매칭"}
+    return {
+        name: _df.groupby(col, observed=True, sort=False).indices
+        for name, col in cols.items() if col in _df.columns
+    }
+
+indices = build_indices(df_view, view_key)
+
+selections = {
+    "branch": None if "전체" in sel_branches else sel_branches,
+    "mgr": None if "전체" in sel_managers else sel_managers,
+    "risk": sel_risk or None,
+    "match": sel_match or None,
+}
 
-if sel_risk:
-    if "리스크등급" in df_f.columns:
-        df_f = df_f[df_f["리스크등급"].isin(sel_risk)]
+rows = np.arange(len(df_view))
+for key, values in selections.items():
+    if values is None or key not in indices:
+        continue
+    hit = [indices[key][v] for v in values if v in indices[key]]
+    hit = np.concatenate(hit) if hit else np.empty(0, dtype=rows.dtype)
+    rows = np.intersect1d(rows, hit, assume_unique=True)
 
-if sel_match:
-    if "체미매칭" in df_f.columns:
-        df_f = df_f[df_f["체미매칭"].isin(sel_match)]
+df_f = df_view.iloc[rows]
 
 if SEL_VOC_MID := sel_voc_mid:
     if sel_voc_mid != "전체" and "VOC유형중" in df_f.columns:
@@ -411,74 +621,120 @@ if SEL_VOC_MID := sel_voc_mid:
 
 df_f = df_f[(df_f["월정료_천원"] >= fee_min) & (df_f["월정료_천원"] <= fee_max)]
 
+if len(daterange) == 2 and "접수일_date" in df_f.columns:
+    start, end = map(pd.Timestamp, daterange)
+    df_f = df_f[df_f["접수일_date"].between(start, end)]
+
 
 # ------------------------------------------------------------
-# 📌 5) KPI 카드
+# 📌 4) KPI 카드
 # ------------------------------------------------------------
-c1, c2, c3, c4 = st.columns(4)
+@st.cache_data(max_entries=64)
+def kpis(_df, key):
+    """KPI 4종 (행 수, 유니크 계약 수, 비매칭 건수, 평균 월정료) — key = filter_key"""
+    n = len(_df)
+    uniq = _df["계약번호_정제"].nunique()
+    # 비매칭 mask 는 NumPy 버퍼에서 1회만 생성
+    xcnt = int((_df["체미매칭"].values == "X").sum()) if "체미매칭" in _df.columns else None
+    avg = float(_df["월정료_천원"].mean()) if n else 0.0
+    return n, uniq, xcnt, avg
+
+def render_kpis(df, key):
+    """KPI 카드 4종"""
+    n_rows, n_uniq, n_unmatched, avg_fee = kpis(df, key)
 
-c1.metric("총 행 수", f"{len(df_f):,}")
-c2.metric("유니크 계약 수", f"{df_f['계약번호_정제'].nunique():,}")
-c3.metric("비매칭(X) 계약건", f"{(df_f['체미매칭']=='X').sum():,}" if "체미매칭" in df_f else "-")
-c4.metric("평균 월정료(천원)", f"{df_f['월정료_천원'].mean():.1f}")
+    c1, c2, c3, c4 = st.columns(4)
 
+    c1.metric("총 행 수", f"{n_rows:,}")
+    c2.metric("유니크 계약 수", f"{n_uniq:,}")
+    c3.metric("비매칭(X) 계약건", f"{n_unmatched:,}" if n_unmatched is not None else "-")
+    c4.metric("평균 월정료(천원)", f"{avg_fee:.1f}")
+
+
+render_kpis(df_f, filter_key)
 
 st.markdown("---")
 
 
 # ------------------------------------------------------------
-# 📌 6) 시각화 — 지사별 계약수 (적층)
+# 📌 5) 시각화 — 지사별 계약수 (리스크 적층) / 담당자별 비매칭 TOP 20
 # ------------------------------------------------------------
-st.markdown("### 🏢 지사별 계약 수 (리스크 적층)")
-
-if {"관리지사", "리스크등급"}.issubset(df_f.columns):
+def unmatched(df):
+    """비매칭(X) 행만 추출 (캐시된 집계 함수 안에서 호출 → 별도 캐시 없음)"""
+    return df.loc[df["체미매칭"] == "X"]
+
+@st.cache_data(max_entries=64)
+def branch_risk_pivot(_df, key):
+    # (지사, 등급, 계약) 중복 제거 후 size → 그룹별 nunique 와 동일
+    dedup = _df.drop_duplicates(["관리지사", "리스크등급", "계약번호_정제"])
+    return (
+        dedup.groupby(["관리지사", "리스크등급"], observed=True)
+        .size()
+        .unstack(fill_value=0)
+    )
 
-    pivot = df_f.pivot_table(
-        index="관리지사",
-        columns="리스크등급",
-        values="계약번호_정제",
-        aggfunc="nunique",
-        fill_value=0
+@st.cache_data(max_entries=64)
+def top_unmatched_managers(_df, key):
+    # (담당자, 계약) 중복 제거 후 size → nunique 와 동일, nlargest 로 상위 20
+    return (
+        unmatched(_df)
+        .drop_duplicates(["담당자", "계약번호_정제"])
+        .groupby("담당자", observed=True, sort=False)
+        .size()
+        .nlargest(20)
+        .rename("계약수")
     )
 
-    fig = px.bar(
-        pivot,
-        x=pivot.index,
-        y=["HIGH", "MEDIUM, 'LOW"],
+@st.cache_resource(max_entries=64)
+def branch_risk_fig(_pivot, key):
+    # Figure 는 직렬화 대상이 아니므로 cache_resource
+    return px.bar(
+        _pivot,
+        x=_pivot.index,
+        y=list(_pivot.columns),     # RISK_DTYPE 순서 (HIGH → MEDIUM → LOW)
         title="지사별 계약수 (리스크 적층)",
         barmode="stack",
         text_auto=True
     )
-    st.plotly_chart(fig, use_container_width=True)
-else:
-    st.info("지사 또는 리스크 데이터가 부족하여 시각화를 생성할 수 없습니다.")
 
+@st.cache_resource(max_entries=64)
+def top_unmatched_fig(_top, key):
+    return px.bar(
+        _top,
+        title="담당자별 비매칭 TOP 20",
+        text_auto=True
+    )
 
-# ------------------------------------------------------------
-# 📌 7) 담당자별 비매칭 TOP 20
-# ------------------------------------------------------------
-if "담당자" in df_f.columns and "체미매칭" in df_f.columns:
+def render_charts(df, key):
+    """지사별 리스크 적층 + 담당자별 비매칭 TOP 20 (집계는 key 단위 캐시)"""
+    st.markdown("### 🏢 지사별 계약 수 (리스크 적층)")
 
-    st.markdown("### 👤 담당자별 비매칭 TOP 20")
+    if {"관리지사", "리스크등급"}.issubset(df.columns):
 
-    top_fail = (
-        df_f[df_f["체미매칭"]=="X"]
-        .groupby("담당자")["계약번호_정제"]
-        .nunique()
-        .sort_values(ascending=False)
-        .head(20)
-    )
+        pivot = branch_risk_pivot(df, key)
+        if pivot.empty:     # 필터 결과 0건 → px.bar(y=[]) 오류 방지
+            st.info("선택한 조건에 해당하는 데이터가 없습니다.")
+        else:
+            st.plotly_chart(branch_risk_fig(pivot, key), use_container_width=True)
+    else:
+        st.info("지사 또는 리스크 데이터가 부족하여 시각화를 생성할 수 없습니다.")
 
-    fig2 = px.bar(
-        top_fail,
-        title="담당자별 비매칭 TOP 20",
-        text_auto=True
-    )
-    st.plotly_chart(fig2, use_container_width=True)
+    if "담당자" in df.columns and "체미매칭" in df.columns:
+
+        st.markdown("### 👤 담당자별 비매칭 TOP 20")
+
+        top = top_unmatched_managers(df, key)
+        if top.empty:
+            st.info("선택한 조건에 해당하는 비매칭 데이터가 없습니다.")
+        else:
+            st.plotly_chart(top_unmatched_fig(top, key), use_container_width=True)
+
+
+render_charts(df_f, filter_key)
 
 
 # ------------------------------------------------------------
-# 📌 8) 상세 테이블
+# 📌 6) 상세 테이블
 # ------------------------------------------------------------
 st.markdown("### 📄 필터링된 상세 데이터")
 
@@ -489,38 +745,39 @@ display_cols = [
 
 display_cols = [col for col in display_cols if col in df_f.columns]
 
-st.dataframe(df_f[display_cols], use_container_width=True, height=350)   
+DISPLAY_ROWS = 1000     # 기본 표시 행 수 (전체 표시는 토글)
 
-# ------------------------------------------------------------
-# PART 4 — 활동내역 등록 / 로그 저장 / 관리자 전체 조회
-# ------------------------------------------------------------
+@st.cache_data(max_entries=32)
+def display_frame(_df, cols, key, limit=None):
+    out = _df[cols] if limit is None else _df[cols].head(limit)
+    return out.reset_index(drop=True)
 
-LOG_FILE = "activity_log.csv"
+# 라벨·key 고정 + 항상 렌더링 → 필터로 행 수가 바뀌어도 토글 상태 유지
+# (렌더링되지 않은 위젯은 상태가 지워지므로 행 수가 적을 때는 비활성화만)
+show_all = st.toggle(
+    f"전체 행 표시 (기본 상위 {DISPLAY_ROWS:,}행)",
+    key="show_all_rows",
+    disabled=len(df_f) <= DISPLAY_ROWS,
+)
 
+st.dataframe(
+    display_frame(df_f, display_cols, filter_key, None if show_all else DISPLAY_ROWS),
+    use_container_width=True,
+    height=350,
+    column_config={
+        "월정료_천원": st.column_config.NumberColumn("월정료(천원)", format="%d"),
+    },
+)
 
 # ------------------------------------------------------------
-# 1) 로그 파일 로드 함수
+# PART 4 — 활동내역 등록 / 로그 저장 / 관리자 전체 조회
 # ------------------------------------------------------------
-@st.cache_data
-def load_logs():
-    if os.path.exists(LOG_FILE):
-        try:
-            return pd.read_csv(LOG_FILE, encoding="utf-8-sig")
-        except:
-            return pd.read_csv(LOG_FILE)
-    else:
-        return pd.DataFrame(columns=["계약번호", "활동내용", "등록자", "등록일시", "비고"])
-
-
-def save_logs(df_logs):
-    df_logs.to_csv(LOG_FILE, index=False, encoding="utf-8-sig")
-
 
 logs_df = load_logs()
 
 
 # ------------------------------------------------------------
-# 2) UI — 활동내역 등록
+# 1) UI — 활동내역 등록
 # ------------------------------------------------------------
 st.markdown("## 📝 활동내역 등록")
 
@@ -549,24 +806,23 @@ if st.button("📥 활동내역 등록"):
     elif activity.strip() == "":
         st.error("활동 내용을 입력해주세요.")
     else:
-        new_row = {
-            "계약번호": sel_contract,
-            "활동내용": activity,
-            "등록자": LOGIN_USER,
-            "등록일시": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "비고": note,
-        }
-
-        logs_df = pd.concat([logs_df, pd.DataFrame([new_row])], ignore_index=True)
+        append_log([
+            sel_contract,
+            activity,
+            LOGIN_USER,
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            note,
+        ])
 
-        save_logs(logs_df)
+        load_logs.clear()
+        logs_df = load_logs()
 
         st.success(f"등록 완료! (계약번호: {sel_contract})")
         st.balloons()
 
 
 # ------------------------------------------------------------
-# 3) 관리자 전용 — 전체 활동로그 조회
+# 2) 관리자 전용 — 전체 활동로그 조회
 # ------------------------------------------------------------
 st.markdown("---")
 st.markdown("## 📋 활동내역 조회")
@@ -595,8 +851,71 @@ else:
 # PART 5 — 담당자 이메일 알림 발송 기능 (관리자 전용)
 # ------------------------------------------------------------
 
-import smtplib
-from email.message import EmailMessage
+@st.cache_data(max_entries=32)
+def unmatched_counts(_unmatched, key):
+    """담당자별 비매칭(X) 건수 (key: 데이터 버전 + 로그인 권한)"""
+    return (
+        _unmatched.groupby("담당자", observed=True, sort=False).size()
+        .sort_values(ascending=False)
+        .rename("건수")
+        .reset_index()
+    )
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def attachment_csv(_df, key):
+    """메일 첨부용 CSV bytes (UTF-8 BOM, pyarrow 로 bytes 에 직접 기록) — key = (view_key, 담당자)"""
+    import io
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    # category / datetime → 문자열 (날짜는 to_csv 와 같은 "2026-10-10" 형식, NaT → 빈 칸)
+    str_cols = _df.select_dtypes(["category", "datetime"]).columns
+    df = _df.astype({c: "string" for c in str_cols})
+
+    buf = io.BytesIO()
+    buf.write(b"\xef\xbb\xbf")
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    return buf.getvalue()
+
+
+@st.cache_resource
+def smtp_client():
+    """로그인까지 마친 SMTP 연결 (프로세스 단위로 재사용)"""
+    import smtplib
+
+    smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    smtp.starttls()
+    smtp.login(SMTP_USER, SMTP_PASSWORD)
+    return smtp
+
+
+@st.cache_resource
+def smtp_lock():
+    """smtplib.SMTP 는 스레드 안전하지 않음 → 세션 간 공유 연결 사용을 직렬화
+    (스크립트는 rerun 마다 다시 실행되므로 lock 도 cache_resource 로 프로세스 단위 공유)"""
+    return threading.Lock()
+
+
+def send_mail(msg):
+    """캐시된 연결로 발송, 끊긴 연결은 1회 재접속"""
+    from smtplib import SMTPServerDisconnected
+
+    def reconnect():
+        smtp_client.clear()
+        return smtp_client()
+
+    with smtp_lock():
+        smtp = smtp_client()
+        try:
+            smtp.noop()
+        except Exception:
+            smtp = reconnect()
+        try:
+            smtp.send_message(msg)
+        except SMTPServerDisconnected:     # noop 이후 끊긴 경우
+            reconnect().send_message(msg)
+
 
 st.markdown("---")
 st.markdown("## 📬 담당자 이메일 알림 발송")
@@ -606,25 +925,29 @@ if LOGIN_TYPE != "admin":
 else:
     st.success("관리자 권한: 담당자 이메일 발송 가능")
 
+    manager_contacts = build_manager_contacts(contact_df)
+
     # 비매칭(X) 데이터 기반
-    unmatched_df = df_view[df_view["체미매칭"] == "X"].copy()
+    unmatched_df = unmatched(df_view)
 
     if unmatched_df.empty:
         st.info("현재 비매칭(X) 데이터가 없습니다.")
+    elif "담당자" not in unmatched_df.columns:
+        st.info("담당자 컬럼이 없어 담당자별 알림을 만들 수 없습니다.")
     else:
         # 담당자별 분류
-        grouped = unmatched_df.groupby("담당자")
+        counts = unmatched_counts(unmatched_df, view_key)
 
         st.markdown("### 📊 담당자별 비매칭 데이터")
 
         alert_rows = []
-        for mgr, g in grouped:
+        for mgr, cnt in zip(counts["담당자"], counts["건수"]):
             mgr = str(mgr).strip()
             if mgr == "" or mgr == "nan":
                 continue
 
             email = manager_contacts.get(mgr, {}).get("email", "")
-            alert_rows.append([mgr, email, len(g)])
+            alert_rows.append([mgr, email, cnt])
 
         alert_df = pd.DataFrame(alert_rows, columns=["담당자", "이메일", "비매칭 건수"])
         st.dataframe(alert_df, use_container_width=True, height=260)
@@ -650,6 +973,8 @@ else:
             st.write(f"📌 발송 대상 건수: {len(df_target)}건")
 
             if st.button("📤 이메일 발송하기"):
+                from email.message import EmailMessage
+
                 if custom_email.strip() == "":
                     st.error("이메일 주소를 입력해주세요.")
                 else:
@@ -669,19 +994,15 @@ else:
                         msg.set_content(body)
 
                         # CSV 첨부
-                        csv_bytes = df_target.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
                         msg.add_attachment(
-                            csv_bytes,
+                            attachment_csv(df_target, view_key + (sel_mgr,)),
                             maintype="application",
                             subtype="octet-stream",
                             filename=f"비매칭VOC_{sel_mgr}.csv"
                         )
 
-                        # SMTP 전송
-                        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as smtp:
-                            smtp.starttls()
-                            smtp.login(SMTP_USER, SMTP_PASSWORD)
-                            smtp.send_message(msg)
+                        # SMTP 전송 (캐시된 연결 재사용)
+                        send_mail(msg)
 
                         st.success(f"메일 발송 완료 → {custom_email}")
 